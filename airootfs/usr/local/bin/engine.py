@@ -0,0 +1,662 @@
+#!/usr/bin/env python3
+
+import os
+import queue
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
+import probe
+import firstboot
+
+# -------- Constants --------
+TARGET = "/target"
+# Where archiso keeps the root filesystem image, see install_dir/arch in profiledef.sh
+LIVE_IMAGES = [
+    "/run/archiso/bootmnt/arch/x86_64/airootfs.sfs",
+    "/run/archiso/copytoram/airootfs.sfs",
+]
+# Things in airootfs/ that only make sense on the live ISO, relative to the target root
+LIVE_ONLY = [
+    "etc/mkinitcpio.conf.d/archiso.conf",
+    "etc/systemd/system/getty@tty1.service.d",
+    "etc/sudoers.d/01-arch",
+    "etc/motd",
+    "root/.automated_script.sh",
+    "root/.zlogin",
+    "etc/systemd/system/choose-mirror.service",
+    "etc/systemd/system/pacman-init.service",
+    "etc/systemd/system/etc-pacman.d-gnupg.mount",
+    "etc/systemd/system/archiso-mkfile.service",
+    "etc/systemd/system/mkramswap.service",
+    "etc/systemd/system/livecd-talk.service",
+    "etc/systemd/system/livecd-alsa-unmuter.service",
+    "etc/systemd/system/reflector.service.d/archiso.conf",
+    "etc/systemd/system/multi-user.target.wants/choose-mirror.service",
+    "etc/systemd/system/multi-user.target.wants/livecd-talk.service",
+    "etc/systemd/system/multi-user.target.wants/pacman-init.service",
+    "etc/systemd/system/multi-user.target.wants/reflector.service",
+    "etc/systemd/system/multi-user.target.wants/sshd.service",
+    "etc/systemd/system/multi-user.target.wants/iwd.service",
+    "etc/systemd/system/multi-user.target.wants/systemd-networkd.service",
+    "etc/systemd/system/sockets.target.wants/systemd-networkd.socket",
+    "etc/systemd/system/network-online.target.wants/systemd-networkd-wait-online.service",
+    "etc/systemd/system/systemd-networkd-wait-online.service.d",
+    "etc/systemd/system/dbus-org.freedesktop.network1.service",
+    "etc/systemd/system/sound.target.wants/livecd-alsa-unmuter.service",
+    "etc/systemd/system/sysinit.target.wants/systemd-time-wait-sync.service",
+    "etc/systemd/system/cloud-init.target.wants",
+    "etc/systemd/system-generators/systemd-gpt-auto-generator",
+    "etc/systemd/journald.conf.d/volatile-storage.conf",
+    "etc/systemd/logind.conf.d/do-not-suspend.conf",
+    "etc/systemd/resolved.conf.d/archiso.conf",
+    "etc/ssh/sshd_config.d/10-archiso.conf",
+    "usr/local/bin/choose-mirror",
+    "usr/local/bin/Installation_guide",
+    "usr/local/bin/livecd-sound",
+    "usr/local/bin/create-zram.sh",
+    "usr/local/bin/launch.sh",
+    "usr/local/bin/main.py",
+    "usr/local/bin/engine.py",
+    "usr/local/bin/loggery.py",
+    "usr/local/bin/probe.py",
+    "usr/local/bin/firstboot.py",
+    "usr/local/share/livecd-sound",
+    "usr/local/share/installer",
+]
+# Groups packages.x86_64 installs in full, so they are complete on the live image. Written by build.sh
+LIVE_GROUPS_FILE = "/usr/local/share/installer/live-groups"
+# Per machine state that must not be shared between installs
+MACHINE_STATE = [
+    "etc/machine-id",
+    "var/lib/systemd/random-seed",
+    "var/lib/dbus/machine-id",
+    "var/log/journal",
+    "var/cache/pacman/pkg",
+]
+# The preset the linux package ships, replaces the archiso one
+LINUX_PRESET = """# mkinitcpio preset file for the 'linux' package
+
+#ALL_config="/etc/mkinitcpio.conf"
+ALL_kver="/boot/vmlinuz-linux"
+
+PRESETS=('default' 'fallback')
+
+default_image="/boot/initramfs-linux.img"
+
+fallback_image="/boot/initramfs-linux-fallback.img"
+fallback_options="-S autodetect"
+"""
+
+# -------- Events --------
+
+@dataclass
+class Event:
+    """Base class for everything the engine sends to a front end."""
+    stage: str = ""
+
+
+@dataclass
+class StageStarted(Event):
+    pass
+
+
+@dataclass
+class StageFinished(Event):
+    pass
+
+
+@dataclass
+class Progress(Event):
+    """done: finished stages, total: all stages"""
+    done: int = 0
+    total: int = 0
+
+
+@dataclass
+class LogLine(Event):
+    """level is one of the hprint levels ("debug", "info", ...)"""
+    message: str = ""
+    level: str = "debug"
+
+
+@dataclass
+class PromptNeeded(Event):
+    """
+    The engine is blocked until the front end calls InstallEngine.reply().
+
+    key: what is being asked (e.g. "network"), so front ends can special-case it
+    message: human readable question
+    choices: list of valid answers, or None for free text / just a confirmation
+    """
+    key: str = ""
+    message: str = ""
+    choices: list = None
+
+
+@dataclass
+class Error(Event):
+    message: str = ""
+
+
+@dataclass
+class Finished(Event):
+    """Always the last event, success is False if any stage failed."""
+    success: bool = True
+
+
+class EngineError(Exception):
+    """Raised by stages, turned into an Error event by the engine."""
+
+
+# -------- Stages --------
+
+@dataclass
+class Stage:
+    """
+    name: unique stage name, used in events and in requires
+    func: callable taking the engine
+    requires: stage names that must finish first, names not in the plan are ignored
+    """
+    name: str
+    func: object
+    requires: tuple = field(default_factory=tuple)
+
+
+def _stage_network(engine):
+    """Make sure we can reach the internet, ask the front end to fix it otherwise."""
+    if engine.online or engine.dry_run:
+        return
+    def runping(hostname):
+        h = subprocess.run(["ping", "-c", "1", "-w2", hostname], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return h.returncode == 0
+
+    while True:
+        if runping("google.com"):
+            break
+        engine.log("Networking has failed (google.com), trying direct-IP", "warning")
+        if runping("1.1.1.1"):
+            break
+        engine.log("Networking has still failed on direct-IP (1.1.1.1)", "warning")
+        engine.prompt("network", "No network connection. Set up a connection, then continue to retry.")
+    engine.online = True
+
+
+def _stage_mount(engine):
+    """Mount config["partitions"] under TARGET, parents before children."""
+    partitions = sorted(engine.config.get("partitions", []), key=lambda p: p["mount"].rstrip("/").count("/"))
+    if not any(part["mount"].rstrip("/") == "" for part in partitions):
+        # Otherwise everything would be installed into the live system's RAM
+        raise EngineError("No partition selected for /, refusing to install")
+    engine.run(["mkdir", "-p", TARGET], "Make " + TARGET)
+    for part in partitions:
+        mountpoint = TARGET + part["mount"].rstrip("/")
+        engine.run(["mkdir", "-p", mountpoint], f"Create mountpoint {mountpoint}")
+        engine.run(["mount", part["device"], mountpoint], f"Mounting {part['device']} to {mountpoint}")
+
+
+def _stage_probe(engine):
+    """Measure the machine and size downloads, builds, swap and stage concurrency to it."""
+    cores = probe.cpu_count()
+    ram = probe.ram_mib()
+    disk = None if engine.dry_run else probe.disk_write_mbps(TARGET)
+    net = None
+    if engine.online:
+        url = probe.mirror_url()
+        if url:
+            net = probe.network_mbps(url)
+    def fmt(value, unit):
+        return "unknown" if value is None else f"{value:.0f} {unit}"
+
+    engine.log(f"Measured: {cores} cores, RAM {fmt(ram, 'MiB')}, disk write {fmt(disk, 'MiB/s')}, network {fmt(net, 'MiB/s')}", "info")
+
+    tuning = probe.tune(cores, ram, disk, net)
+    engine.config.update(tuning)
+    engine.max_parallel = tuning["parallel_stages"]
+    engine.log("Tuning: " + ", ".join(f"{k}={v}" for k, v in tuning.items()), "info")
+    # pacstrap uses the live pacman.conf
+    engine.set_parallel_downloads("/etc/pacman.conf")
+
+
+def _stage_tune_target(engine):
+    """Carry the probe results over to the installed system's pacman and makepkg."""
+    jobs = engine.config.get("build_jobs", probe.cpu_count())
+    engine.set_parallel_downloads(TARGET + "/etc/pacman.conf")
+    engine.run(["mkdir", "-p", TARGET + "/etc/makepkg.conf.d"], "Make makepkg.conf.d")
+    engine.write(TARGET + "/etc/makepkg.conf.d/jobs.conf",
+        f'MAKEFLAGS="-j{jobs}"\n'
+        f'export CARGO_BUILD_JOBS={jobs}\n'
+        f'export GOFLAGS="-p={jobs}"\n')
+
+
+def _stage_swap(engine):
+    """Swap file on the target so pacstrap/makepkg don't run out of memory on the live system."""
+    swap = TARGET + "/swap.img"
+    engine.run(["dd", "if=/dev/zero", f"of={swap}", "bs=1M", f"count={engine.config.get('swap_mib', 16*1024)}"], "Make swap image")
+    engine.run(["chmod", "600", swap], "Swap image permissions")
+    engine.run(["mkswap", swap], "Format swap image")
+    engine.run(["swapon", swap], "Enable swap image")
+
+
+def _stage_keyring(engine):
+    """Update keyring and DBs so we don't have any download issues"""
+    engine.run(["pacman", "-Sy", "--noconfirm", "archlinux-keyring"], "Update keyring")
+
+
+def _stage_pacstrap(engine):
+    engine.run(["pacstrap", "-K", TARGET, "base", "linux", "linux-firmware"] + engine.packages(), "Install base system")
+
+
+def _stage_fstab(engine):
+    fstab = engine.run(["genfstab", "-U", TARGET], "Generate fstab")
+    engine.write(TARGET + "/etc/fstab", fstab, append=True)
+
+
+def _stage_locale(engine):
+    """Timezone, locale, keymap and hostname"""
+    config = engine.config
+    engine.chroot(["ln", "-sf", f"/usr/share/zoneinfo/{config['timezone']}", "/etc/localtime"], "Timezone symlink")
+    engine.chroot(["hwclock", "--systohc"], "Sync time")
+    engine.write(TARGET + "/etc/locale.gen", f"{config['lang']}.UTF-8 UTF-8\n", append=True)
+    engine.chroot(["locale-gen"], "Generate locales")
+    engine.write(TARGET + "/etc/locale.conf", f"LANG={config['lang']}.UTF-8\nLC_ALL={config['lang']}.UTF-8\n")
+    engine.write(TARGET + "/etc/vconsole.conf", f"KEYMAP={config['keymap']}\n")
+    engine.write(TARGET + "/etc/hostname", config["hostname"] + "\n")
+
+
+def _stage_users(engine):
+    user = engine.config["username"]
+    engine.chroot(["useradd", "-m", "-G", "video,storage,wheel", "-s", "/bin/bash", user["name"]], "Add user")
+    engine.write(TARGET + "/etc/sudoers.d/10-wheel", "%wheel ALL=(ALL:ALL) ALL\n")
+    passwords = f"root:{engine.config['rootpw']}\n"
+    if user.get("pw"):
+        passwords += f"{user['name']}:{user['pw']}\n"
+    else:
+        engine.chroot(["passwd", "-d", user["name"]], "Remove user password")
+    engine.chroot(["chpasswd"], "Set passwords", input=passwords)
+
+
+def _stage_aur(engine):
+    """Build paru and yay (yay as a backup incase paru breaks) as a temporary user, makepkg refuses root"""
+    if engine.config.get("defer_optional", True):
+        # Not needed to boot, let the first-boot service build them
+        for helper in ("paru", "yay"):
+            engine.defer(f"aur-{helper}", firstboot.aur_helper_task(helper))
+        return
+    _stage_network(engine)
+    _refresh_keyring(engine)
+    engine.chroot(["pacman", "-Syu", "--needed", "--noconfirm", "git", "base-devel"], "Install build tools")
+    engine.chroot(["useradd", "-m", "-s", "/bin/bash", "tmpusr"], "Add a temporary user")
+    engine.write(TARGET + "/etc/sudoers.d/99-tmpusr", "tmpusr ALL=(ALL:ALL) NOPASSWD: ALL\n")
+    try:
+        for helper in ("paru", "yay"):
+            engine.chroot(["sudo", "-u", "tmpusr", "git", "clone", f"https://aur.archlinux.org/{helper}.git", f"/home/tmpusr/{helper}"], f"Downloading AUR helper {helper}")
+            engine.chroot(["sudo", "-u", "tmpusr", "bash", "-c", f"cd /home/tmpusr/{helper} && makepkg -si --noconfirm"], f"Building AUR helper {helper}")
+    finally:
+        engine.run(["rm", "-f", TARGET + "/etc/sudoers.d/99-tmpusr"], "Remove temporary sudoers rule")
+        engine.chroot(["userdel", "-r", "tmpusr"], "Remove temporary user")
+
+
+def _stage_bootloader(engine):
+    if engine.config["boot_mode"] == "uefi":
+        engine.chroot(["grub-install", "--removable", "--bootloader-id=arch", "--efi-directory=/boot/efi"], "Running grub-install")#--removable so it may not get nuked by windows
+        engine.chroot(["grub-mkconfig", "-o", "/boot/grub/grub.cfg"], "Running grub-mkconfig")
+    else:
+        engine.log("BIOS boot is not implemented yet, no bootloader installed", "warning")#TODO: Implement BIOS boot
+
+
+def _stage_firstboot(engine):
+    """Install and enable the service that runs the deferred tasks, only if something was deferred."""
+    if not engine.deferred:
+        return
+    engine.log("Deferred to first boot: " + ", ".join(engine.deferred), "info")
+    engine.write(TARGET + firstboot.RUNNER, firstboot.RUNNER_SCRIPT)
+    engine.run(["chmod", "755", TARGET + firstboot.RUNNER], "Make first-boot runner executable")
+    engine.write(TARGET + firstboot.UNIT, firstboot.UNIT_FILE)
+    # Nothing else enables a network service on a pacstrap install, the clone already has these enabled
+    engine.chroot(["systemctl", "enable", "NetworkManager.service", "NetworkManager-wait-online.service"], "Enable NetworkManager")
+    engine.chroot(["systemctl", "enable", firstboot.UNIT_NAME], "Enable first-boot service")
+
+
+def live_groups():
+    """Names from LIVE_GROUPS_FILE, empty if it is missing (then every group is fetched with --needed)."""
+    try:
+        with open(LIVE_GROUPS_FILE) as file:
+            return {line.strip() for line in file if line.strip()}
+    except OSError:
+        return set()
+
+
+def find_live_image():
+    """Path of the live root filesystem image, or None when not booted from the ISO."""
+    return next((p for p in LIVE_IMAGES if os.path.isfile(p)), None)
+
+
+def _stage_clone(engine):
+    """Unpack the live squashfs straight onto the target instead of downloading everything again."""
+    image = find_live_image()
+    if image is None and not engine.dry_run:
+        raise EngineError("Live root filesystem image not found, use the pacstrap install instead")
+    engine.run(["unsquashfs", "-f", "-no-progress", "-p", str(probe.cpu_count()), "-d", TARGET, str(image)], "Copy live image to target")
+
+
+def _stage_strip_live(engine):
+    """Turn the copied live system into a normal install."""
+    engine.run(["rm", "-rf"] + [os.path.join(TARGET, p) for p in LIVE_ONLY + MACHINE_STATE], "Remove live-only configuration")
+    # Autologin as the live user, the rest of the sddm config is fine to keep
+    engine.strip_section(TARGET + "/etc/sddm.conf.d/kde_settings.conf", "Autologin")
+    engine.chroot(["userdel", "-r", "arch"], "Remove live user")
+    engine.write(TARGET + "/etc/machine-id", "")#systemd makes a new one on first boot
+    engine.write(TARGET + "/etc/fstab", "# Static information about the filesystems.\n# See fstab(5) for details.\n\n")
+    engine.run(["mkdir", "-p", TARGET + "/var/log/journal", TARGET + "/var/cache/pacman/pkg"], "Recreate emptied directories")
+
+    # /etc/pacman.d/gnupg is a tmpfs on the ISO, so the copy has no keyring
+    engine.chroot(["pacman-key", "--init"], "Init pacman keyring")
+    engine.chroot(["pacman-key", "--populate", "archlinux"], "Populate pacman keyring")
+
+    # mkarchiso empties /boot, the kernel is still in the modules directory
+    engine.run(["sh", "-c", f"cp {TARGET}/usr/lib/modules/*/vmlinuz {TARGET}/boot/vmlinuz-linux"], "Copy kernel")
+    engine.write(TARGET + "/etc/mkinitcpio.d/linux.preset", LINUX_PRESET)
+    engine.chroot(["pacman", "-Rdd", "--noconfirm", "mkinitcpio-archiso"], "Remove archiso initcpio hooks")
+    engine.chroot(["mkinitcpio", "-P"], "Build initramfs")
+
+
+def _refresh_keyring(engine):
+    """The keyring on the target is as old as the ISO, update it before installing anything signed after that"""
+    engine.chroot(["pacman", "-Sy", "--needed", "--noconfirm", "archlinux-keyring"], "Update keyring")
+
+
+def _stage_packages(engine):
+    """Install only the selected packages the live image doesn't already have."""
+    missing = engine.missing_packages(engine.packages())
+    if not missing:
+        engine.log("All selected packages are already on the live image", "info")
+        return
+    engine.log("Packages to download: " + " ".join(missing), "info")
+    _stage_network(engine)
+    _refresh_keyring(engine)
+    # -u as well, the image is older than the mirrors and -Sy alone would be a partial upgrade.
+    # --needed skips the members of a group that are already installed
+    engine.chroot(["pacman", "-Syu", "--needed", "--noconfirm"] + missing, "Install missing packages")
+
+
+def default_stages():
+    """The full pacstrap based install, in a valid order."""
+    return [
+        Stage("network", _stage_network),
+        Stage("mount", _stage_mount),
+        Stage("probe", _stage_probe, ("mount", "network")),
+        Stage("swap", _stage_swap, ("probe",)),
+        Stage("keyring", _stage_keyring, ("probe",)),
+        Stage("pacstrap", _stage_pacstrap, ("keyring", "swap")),
+        Stage("tune_target", _stage_tune_target, ("pacstrap",)),
+        Stage("fstab", _stage_fstab, ("pacstrap",)),
+        Stage("locale", _stage_locale, ("pacstrap",)),
+        Stage("users", _stage_users, ("pacstrap",)),
+        Stage("aur", _stage_aur, ("users", "tune_target")),
+        Stage("bootloader", _stage_bootloader, ("pacstrap",)),
+        Stage("firstboot", _stage_firstboot, ("aur",)),
+    ]
+
+
+def clone_stages():
+    """Install by copying the live image, network is only needed for missing packages and the AUR."""
+    return [
+        Stage("mount", _stage_mount),
+        Stage("probe", _stage_probe, ("mount",)),
+        Stage("clone", _stage_clone, ("probe",)),
+        Stage("swap", _stage_swap, ("clone",)),# Both write the whole disk, no point in them fighting over it
+        Stage("strip_live", _stage_strip_live, ("clone",)),
+        Stage("tune_target", _stage_tune_target, ("strip_live",)),
+        Stage("packages", _stage_packages, ("tune_target",)),
+        Stage("fstab", _stage_fstab, ("strip_live", "swap")),
+        Stage("locale", _stage_locale, ("strip_live",)),
+        Stage("users", _stage_users, ("strip_live",)),
+        Stage("aur", _stage_aur, ("users", "packages", "swap")),
+        Stage("bootloader", _stage_bootloader, ("packages",)),
+        Stage("firstboot", _stage_firstboot, ("aur",)),
+    ]
+
+
+# -------- Engine --------
+
+class InstallEngine:
+    """
+    Runs the install described by a config dict on a worker thread and reports
+    back through events, so it can be driven by the terminal or a Qt UI.
+
+    config: same dict the prompts fill in (hostname, username, partitions, ...)
+    stages: list of Stage, clone_stages() or default_stages() depending on config["install_mode"] if None
+    dry_run: log commands instead of running them
+    max_parallel: how many independent stages may run at once (config["parallel_stages"] if None),
+                  the probe stage replaces it with what the machine can handle
+
+    Usage:
+        engine = InstallEngine(config)
+        engine.start()
+        for event in engine.events():
+            if isinstance(event, PromptNeeded): engine.reply(input(event.message))
+    """
+
+    def __init__(self, config, stages=None, dry_run=False, max_parallel=None):
+        self.config = config
+        if stages is None:
+            stages = clone_stages() if config.get("install_mode") == "clone" else default_stages()
+        self.stages = stages
+        self.dry_run = dry_run
+        self.max_parallel = max(1, max_parallel or config.get("parallel_stages", 1))
+        self._events = queue.Queue()
+        self._replies = queue.Queue()
+        self._prompt_lock = threading.Lock()
+        self._chroot_lock = threading.Lock()
+        self._local = threading.local()
+        self._thread = None
+        self.online = False
+        self.deferred = []
+        self._defer_lock = threading.Lock()
+
+    # ---- Front end API ----
+
+    def start(self):
+        """Start the install on a background thread and return immediately."""
+        if self._thread is not None:
+            raise RuntimeError("Engine already started")
+        self._thread = threading.Thread(target=self._run, name="install-engine", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def events(self, timeout=None):
+        """Yield events until (and including) Finished. With a timeout, yields None when nothing arrived."""
+        while True:
+            try:
+                event = self._events.get(timeout=timeout)
+            except queue.Empty:
+                yield None
+                continue
+            yield event
+            if isinstance(event, Finished):
+                return
+
+    def poll(self):
+        """Non-blocking, returns the next event or None (for UI timers)."""
+        try:
+            return self._events.get_nowait()
+        except queue.Empty:
+            return None
+
+    def reply(self, answer):
+        """Answer the PromptNeeded the engine is waiting on."""
+        self._replies.put(answer)
+
+    # ---- Stage API ----
+
+    def emit(self, event):
+        if not event.stage:
+            event.stage = getattr(self._local, "stage", "")
+        self._events.put(event)
+
+    def log(self, message, level="debug"):
+        self.emit(LogLine(message=str(message), level=level))
+
+    def prompt(self, key, message, choices=None):
+        """Ask the front end something and block until it replies, one prompt at a time."""
+        with self._prompt_lock:
+            self.emit(PromptNeeded(key=key, message=message, choices=choices))
+            return self._replies.get()
+
+    def run(self, cmd: list, desc: str = "", input=None, check=True):
+        """
+        Run a command, streaming its output as LogLine events.
+        Honors dry-run mode. Returns stdout as a string, raises EngineError on failure unless check is False.
+        """
+        self.log(f"Running: {' '.join(cmd)}")
+        if self.dry_run:
+            self.log(f"[DRY RUN] {desc}", "info")
+            return ""
+
+        try:
+            proc = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True
+            )
+        except OSError as e:
+            raise EngineError(f"Could not run {cmd[0]}: {e}")
+        if input is not None:
+            proc.stdin.write(input)
+            proc.stdin.close()
+        output = []
+        for line in proc.stdout:
+            output.append(line)
+            self.log(line.rstrip("\n"))
+        returncode = proc.wait()
+        if returncode != 0 and check:
+            raise EngineError(f"Command failed ({returncode}): {desc or ' '.join(cmd)}")
+        return "".join(output)
+
+    def chroot(self, cmd: list, desc: str = "", input=None):
+        """
+        Run a command in chroot based off run(...)
+        One at a time: every arch-chroot mounts proc/sys/dev/run/tmp under TARGET and unmounts them
+        on exit, so overlapping ones pull the mounts out from under each other (and would fight over
+        /etc/passwd and the pacman lock anyway). Only work outside the chroot really runs in parallel.
+        """
+        with self._chroot_lock:
+            return self.run(["arch-chroot", TARGET] + cmd, desc, input=input)
+
+    def write(self, path, text, append=False):
+        """Write a file (usually on the target), honors dry-run mode."""
+        self.log(f"Writing {path}")
+        if self.dry_run:
+            return
+        with open(path, "a" if append else "w") as file:
+            file.write(text)
+
+    def defer(self, name, script):
+        """Queue a bash script to run on the installed system at first boot, in the order deferred."""
+        with self._defer_lock:
+            self.deferred.append(name)
+            path = f"{TARGET}{firstboot.QUEUE_DIR}/{len(self.deferred):02d}-{name}.sh"
+        self.run(["mkdir", "-p", TARGET + firstboot.QUEUE_DIR], "Make first-boot queue")
+        self.write(path, script)
+
+    def set_parallel_downloads(self, path):
+        """Set ParallelDownloads in a pacman.conf to config["parallel_downloads"]"""
+        n = self.config.get("parallel_downloads")
+        if n is None:
+            return
+        self.run(["sed", "-i", "-E", f"s/^#?ParallelDownloads.*/ParallelDownloads = {n}/", path], f"ParallelDownloads = {n} in {path}")
+
+    def strip_section(self, path, section):
+        """Remove an [section] from an ini style file, honors dry-run mode."""
+        self.log(f"Removing [{section}] from {path}")
+        if self.dry_run or not os.path.isfile(path):
+            return
+        with open(path) as file:
+            lines = file.readlines()
+        kept = []
+        skipping = False
+        for line in lines:
+            if line.startswith("["):
+                skipping = line.strip() == f"[{section}]"
+            if not skipping:
+                kept.append(line)
+        with open(path, "w") as file:
+            file.writelines(kept)
+
+    def missing_packages(self, pkgs):
+        """
+        Packages (or groups) from pkgs that are not installed on the target.
+
+        A group only counts as installed if it is in live_groups(), one installed member
+        doesn't mean the rest is there (nautilus is on the image, gnome isn't).
+        Checking every member needs the sync databases, which the image doesn't have.
+        """
+        groups = live_groups()
+        missing = []
+        for pkg in pkgs:
+            # -T also accepts provides
+            if pkg in groups or self.run(["pacman", "--root", TARGET, "-T", pkg], f"Check {pkg}", check=False).strip() == "":
+                continue
+            missing.append(pkg)
+        return missing
+
+    def packages(self):
+        """Extra packages on top of base, from the selections in config"""
+        config = self.config
+        pkgs = " ".join(config.get("browser_packages", [])) + " " + (config.get("de_packages") or "")
+        pkgs += " nano sudo gparted gnome-disk-utility man-db"
+        if config.get("boot_mode") == "uefi":
+            pkgs += " grub efibootmgr"
+        if config.get("defer_optional", True):
+            pkgs += " networkmanager"# The first-boot service needs a network, see _stage_firstboot
+        return pkgs.split()
+
+    # ---- Internals ----
+
+    def _run_stage(self, stage):
+        self._local.stage = stage.name
+        try:
+            self.emit(StageStarted())
+            stage.func(self)
+            self.emit(StageFinished())
+        finally:
+            self._local.stage = ""
+
+    def _run(self):
+        names = {s.name for s in self.stages}
+        pending = list(self.stages)
+        running = {}
+        done = set()
+        success = True
+
+        # max_parallel can change while running (probe stage), so the pool is sized for the worst case
+        with ThreadPoolExecutor(max_workers=max(1, len(self.stages)), thread_name_prefix="stage") as pool:
+            while pending or running:
+                if success:
+                    for stage in list(pending):
+                        if len(running) >= self.max_parallel:
+                            break
+                        if all(r in done or r not in names for r in stage.requires):
+                            pending.remove(stage)
+                            running[pool.submit(self._run_stage, stage)] = stage
+                if not running:
+                    if pending and success:
+                        self.emit(Error(message="Unsatisfiable stage requirements: " + ", ".join(s.name for s in pending)))
+                        success = False
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    e = future.exception()
+                    if e is not None:
+                        success = False
+                        self.emit(Error(stage=stage.name, message=str(e) if isinstance(e, EngineError) else f"An error has occured in the script: {e!r}"))
+                        continue
+                    done.add(stage.name)
+                    self.emit(Progress(stage=stage.name, done=len(done), total=len(self.stages)))
+
+        self.emit(Finished(success=success))
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# Files for the first-boot service that finishes deferred (not needed to boot) install work.
+# Paths are on the installed system.
+
+QUEUE_DIR = "/var/lib/installer-firstboot/queue"
+RUNNER = "/usr/local/bin/installer-firstboot"
+UNIT = "/etc/systemd/system/installer-firstboot.service"
+UNIT_NAME = "installer-firstboot.service"
+LOG = "/var/log/installer-firstboot.log"
+
+# Runs every task in QUEUE_DIR in order, a task is removed once it succeeded.
+# Failed tasks are retried a few times, then the service fails and systemd restarts it later,
+# up to MAX_RUNS times (counted in QUEUE_DIR/.runs).
+# When the queue is empty, or it gave up, the service disables and deletes itself, the log stays.
+RUNNER_SCRIPT = f"""#!/bin/bash
+QUEUE="{QUEUE_DIR}"
+LOG="{LOG}"
+ATTEMPTS=3
+MAX_RUNS=6
+
+status() {{
+    echo "$1" | tee -a "$LOG"
+    systemd-notify --status="$1" 2>/dev/null || true
+}}
+
+# Deferred tasks download things, wait a while for the network instead of failing straight away
+for _ in $(seq 60); do
+    curl -sfI --max-time 5 https://archlinux.org >/dev/null && break
+    status "Waiting for network"
+    sleep 10
+done
+
+remove_self() {{
+    systemctl disable {UNIT_NAME}
+    rm -rf "$(dirname "$QUEUE")" "{UNIT}" "{RUNNER}"
+}}
+
+runs=$(( $(cat "$QUEUE/.runs" 2>/dev/null || echo 0) + 1 ))
+echo "$runs" >"$QUEUE/.runs"
+
+tasks=("$QUEUE"/*.sh)
+total=${{#tasks[@]}}
+n=0
+failed=0
+for task in "${{tasks[@]}}"; do
+    [ -f "$task" ] || continue
+    n=$((n+1))
+    name=$(basename "$task" .sh)
+    for attempt in $(seq $ATTEMPTS); do
+        status "[$n/$total] $name (attempt $attempt/$ATTEMPTS)"
+        if bash "$task" >>"$LOG" 2>&1; then
+            rm -f "$task"
+            status "[$n/$total] $name done"
+            break
+        fi
+        status "[$n/$total] $name failed"
+        [ "$attempt" -lt "$ATTEMPTS" ] && sleep $((attempt*30))
+    done
+    [ -f "$task" ] && failed=$((failed+1))
+done
+
+if [ "$failed" -ne 0 ]; then
+    if [ "$runs" -ge "$MAX_RUNS" ]; then
+        status "Giving up after $runs runs, not done: $(ls "$QUEUE"/*.sh | xargs -n1 basename | tr '\\n' ' ')"
+        status "Removing {UNIT_NAME}, see $LOG"
+        remove_self
+        exit 0
+    fi
+    status "$failed deferred task(s) failed (run $runs/$MAX_RUNS), will retry later, see $LOG"
+    exit 1
+fi
+
+status "All deferred tasks done, removing {UNIT_NAME}"
+remove_self
+"""
+
+# Normal priority, tasks lower it themselves for the long builds (see TASK_HELPERS).
+# Package transactions must not be slowed down, a shutdown in the middle of one can leave the system unbootable
+UNIT_FILE = f"""[Unit]
+Description=Finish deferred install tasks
+Wants=network-online.target
+After=network-online.target
+ConditionPathExists={QUEUE_DIR}
+StartLimitIntervalSec=0
+
+[Service]
+Type=simple
+ExecStart={RUNNER}
+NotifyAccess=all
+Restart=on-failure
+RestartSec=10min
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+
+# Sourced at the top of every task.
+# txn: pacman with shutdown/sleep blocked and the user told about it
+# idle: lowest CPU and I/O priority, for builds
+TASK_HELPERS = """txn() {
+    echo "Package transaction running in the background, do not power off: pacman $*"
+    wall "Installer: installing/upgrading packages in the background, please don't shut down until it finishes." 2>/dev/null || true
+    systemd-inhibit --what=shutdown:sleep --mode=block --who=installer-firstboot --why="Installing packages" pacman "$@"
+}
+
+idle() {
+    nice -n 19 ionice -c 3 "$@"
+}
+"""
+
+
+def aur_helper_task(helper):
+    """
+    Task script that builds an AUR helper as a temporary user, makepkg refuses root. Safe to rerun.
+    Only the build runs at idle priority, everything pacman does goes through txn.
+    """
+    return f"""#!/bin/bash
+set -e
+{TASK_HELPERS}
+pacman -Q {helper} >/dev/null 2>&1 && exit 0
+
+cleanup() {{
+    rm -f /etc/sudoers.d/99-tmpusr
+    userdel -r tmpusr 2>/dev/null || true
+}}
+trap cleanup EXIT
+cleanup
+
+txn -Sy --needed --noconfirm archlinux-keyring
+txn -Syu --needed --noconfirm git base-devel
+useradd -m -s /bin/bash tmpusr
+cd /home/tmpusr
+runuser -u tmpusr -- git clone https://aur.archlinux.org/{helper}.git {helper}
+cd {helper}
+
+# Build dependencies first, so makepkg itself never has to run pacman
+deps=$(runuser -u tmpusr -- makepkg --printsrcinfo | sed -nE 's/^\t(make|check)?depends = ([^<>=]+).*/\\2/p')
+[ -n "$deps" ] && txn -S --needed --asdeps --noconfirm $deps
+
+idle runuser -u tmpusr -- makepkg --noconfirm
+txn -U --noconfirm $(runuser -u tmpusr -- makepkg --packagelist | grep -v -- '-debug-')
+"""
@@ -6,6 +6,7 @@ import subprocess
 import json
 import logging
 from loggery import hprint
+from engine import InstallEngine, find_live_image, StageStarted, Progress, LogLine, PromptNeeded, Error, Finished
 import threading
 
 # -------- Logging Setup --------
@@ -54,45 +55,49 @@ def detect_boot_mode():
 
 # -------- Stage Functions --------
 
-def iso_stage(config):
+def run_engine(config):
     """
-    Runs in ISO environment.
-    Responsible for partitioning, pacstrap, genfstab.
+    Terminal front end for engine.InstallEngine.
+    Runs the install in the background and logs/prompts from its events.
     """
-    hprint("Starting ISO stage", "info", handler, "main")
-
-
-    #Network setup stage using NetworkManager
-    def runping(hostname):
-        """Runs a ping and if it fails, raises Exception "Returncode", otherwise returns True"""
-        h=subprocess.run("ping -c 1 -w2 " + hostname + " >/dev/null 2>&1".split(" "))
-        if h.returncode!=0:raise Exception("Returncode")
-        return True
-
-    hprint("Stage: Network setup", "info", handler, "main")
-    count=0
-    while True:
-        try:
-            if runping("google.com"):break
-        except Exception as e:
-            if str(e)=="Returncode":
-                if count>=1:hprint("Networking has failed (google.com)")
-                print("Trying direct-IP")
-                try:
-                    if runping("1.1.1.1"):break
-                except Exception:
-                    if str(e)=="Returncode":
-                        if count>=1:hprint("Networking has still failed on direct-IP (1.1.1.1)")
-                    else:
-                        hprint(f"An error has occured in the script: {e}")
-                        sys.exit(1)
+    engine = InstallEngine(config, dry_run=not EXECUTE_COMMANDS)
+    engine.start()
+    for event in engine.events():
+        if isinstance(event, StageStarted):
+            hprint(f"Stage: {event.stage}", "info", handler, "main")
+        elif isinstance(event, Progress):
+            hprint(f"Finished {event.stage} ({event.done}/{event.total})", "info", handler, "main")
+        elif isinstance(event, LogLine):
+            hprint(f"[{event.stage}] {event.message}", event.level, handler, "engine")
+        elif isinstance(event, PromptNeeded):
+            if event.key == "network":
+                print("KDE system settings will be opened, please press the plus to add a new connection, then close it, and press enter.")
+                run_cmd(["systemsettings", "kcm_networkmanagement"])#Better to use nmcli probably
+                engine.reply(input("Press enter, once you are done setting up the network"))
+            elif event.choices:
+                while True:
+                    i = input(f"{event.message} ({'/'.join(event.choices)}): ").strip()
+                    if i in event.choices:
+                        break
+                    print("Invalid option.")
+                engine.reply(i)
             else:
-                hprint(f"An error has occured in the script: {e}")
+                engine.reply(input(event.message + " "))
+        elif isinstance(event, Error):
+            hprint(f"Stage {event.stage or '?'} failed: {event.message}", "error", handler, "main")
+        elif isinstance(event, Finished):
+            if not event.success:
+                hprint("Install failed, see the log above", "critical", handler, "main")
                 sys.exit(1)
+            hprint("Install finished", "info", handler, "main")
 
-        print("KDE system settings will be opened, please press the plus to add a new connection, then close it, and press enter.")
-        run_cmd(["systemsettings", "kcm_networkmanagement"])#Better to use nmcli probably
-        input("Press enter, once you are done setting up the network")
+
+def iso_stage(config):
+    """
+    Runs in ISO environment.
+    Asks for everything the install needs, then hands config to run_engine(...)
+    """
+    hprint("Starting ISO stage", "info", handler, "main")
 
 
     #Select disk stage
@@ -242,31 +247,28 @@ def iso_stage(config):
                     print("No valid partition path entered. Please try again.")
                     continue
 
-    #Mounting
-    print("\n--- Mounting selected partitions ---")
-    run_cmd(["mkdir","/target"],"Make /target")
-    for key, device in diskinfo.items():
-        # Identify mountpoint from diskparts by key
-        mountpoint = None
+    # Partitions for the engine to mount, parents before children is handled there
+    config["partitions"] = []
+    if not auto:
         for part in diskparts:
-            if part["key"] == key:
-                mountpoint = "/target"+part["mount"]
-                break
-        if mountpoint:
-            # We create the mountpoint if it doesn't exist
-            if not os.path.exists(mountpoint):
-                run_cmd(["mkdir", "-p", mountpoint], f"Create mountpoint {mountpoint}")
-            run_cmd(["mount", device, mountpoint], f"Mounting {device} to {mountpoint}")
-        else:
-            print(f"Warning: No mount point found for partition key '{key}'. Skipping.")
-    # Mount any extra partitions (custom ones)
-    if 'extraparts' in locals():
+            config["partitions"].append({"device": diskinfo[part["key"]], "mount": part["mount"]})
         for part in extraparts:
-            mountpoint = "/target"+part["path"]
-            device = part["bdevpath"]
-            if not os.path.exists(mountpoint):
-                run_cmd(["mkdir", "-p", mountpoint], f"Create mountpoint {mountpoint} (extra)")
-            run_cmd(["mount", device, mountpoint], f"Mounting {device} to {mountpoint} (extra)")
+            config["partitions"].append({"device": part["bdevpath"], "mount": part["path"]})
+
+    #Install mode, copying the live image is much faster and works offline for the live desktop
+    config["install_mode"] = "pacstrap"
+    if find_live_image():
+        while True:
+            i = input("Copy the live system (c) (fast, no network needed for Plasma) or fresh install with pacstrap (p): ").strip().lower()
+            if i == "c":
+                config["install_mode"] = "clone"
+            elif i != "p":
+                print("Invalid option. Please enter 'c' or 'p'.")
+                continue
+            break
+    else:
+        hprint("Live image not found, using pacstrap", "warning", handler, "main")
+    hprint(f"Install mode: {config['install_mode']}", "info", handler, "main")
 
     #Hostname selection
     import re
@@ -564,57 +566,17 @@ def iso_stage(config):
             print("Incorrect or unavailable keymap. Type '?' to list them. Example: uk, lt, us, de.")
             continue
 
-    #Install
-
-    extrapackages=f"{config["browser_packages"]} {config["de_packages"]} nano sudo gparted gnome-disk-utility git man"
-    if config["boot_mode"]:
-        extrapackages+=" grub efibootmgr"
-    #Make swap image
-    run_cmd(["sudo", "dd","if=/dev/zero","of=/target/swap.img","bs=1M",f"count={str(16*1024)}"])
-    run_cmd(["sudo", "swapon","/target/swap.img"])
-
-    #Update keyring and DBs so we don't have any download issues
-    run_cmd(f"sudo pacman -Sy archlinux-keyring")
-
-    #Install base system with extra packages
-    run_cmd(f"sudo pacstrap -K /target base linux linux-firmware {extrapackages}".split(" "))
-
-    #Setup fstab
-    s=run_cmd(f"sudo genfstab -U /target".split(" "))
-    with open("/target/etc/fstab") as file: file.write(s.stdout)
-
-    def chroot_cmd(cmd,desc=""):
-        """Command to run a command in chroot based off run_cmd(...)"""
-        run_cmd(f"sudo arch-chroot /target {cmd}",desc)
-
-    #Add timezone
-    chroot_cmd(f"ln -sf /usr/share/zoneinfo/{config["timezone"]} /etc/localtime","Timezone symlink")
-    chroot_cmd(f"hwclock --systohc", "Sync time")
-    chroot_cmd(f"locale-gen", "Generate locales")
-    run_cmd("sudo sh -c \"echo \"LANG="+config["locale"]+".UTF-8\nLC_ALL="+config["locale"]+".UTF-8\" >/target/etc/locale.conf\"","Lang, locale.conf")
-    run_cmd("sudo sh -c \"echo \"KEYMAP="+config["keymap"]+"\">/target/etc/vconsole.conf\"","Keymap, vconsole.conf")
-
-    #Add users
-    chroot_cmd(f"useradd -m -G video,storage,wheel -s /bin/bash {config["username"]["name"]}", "Add user")
-
-    #Setup paru and yay
-    chroot_cmd(f"useradd -G video,storage,wheel -s /bin/bash tmpusr", "Add a temporary user")
-
-    run_cmd("sudo mount --bind /tmp /target/tmp")
-    chroot_cmd(f"mkdir /tmp/paru /tmp/yay")
-    chroot_cmd(f"git clone https://aur.archlinux.org/paru.git /tmp/paru","Downloading AUR helper paru")
-    chroot_cmd(f"bash -c \"cd /tmp/paru;sudo -u tmpusr makepkg -si\"","Building AUR helper paru")
-    chroot_cmd(f"git clone https://aur.archlinux.org/yay.git /tmp/yay","Downloading AUR helper yay")
-    chroot_cmd(f"bash -c \"cd /tmp/yay;sudo -u tmpusr makepkg -si\"","Building AUR helper yay")
-
-    chroot_cmd(f"userdel tmpusr","Remove temporary user")
+    # Extras that aren't needed to boot (AUR helpers) can be finished by a background service after the first boot
+    while True:
+        i = input("Build AUR helpers (paru, yay) in the background after first boot (b, faster install) or now (n): ").strip().lower()
+        if i in ("b", "n"):
+            config["defer_optional"] = (i == "b")
+            break
+        print("Invalid option. Please enter 'b' or 'n'.")
 
-    if config["boot_mode"]=="uefi":
-        chroot_cmd(f"grub-install --removable --bootloader-id=arch --efi-directory=/boot/efi","Running grub-install")#--removable so it may not get nuked by windows
-        chroot_cmd(f"grub-mkconfig -o /boot/grub/grub.cfg","Running grub-mkconfig")
-    else:
-        print("NotImplemented")#TODO: Implement BIOS boot
-    #Done, maybe: Forgotten step: Network setup
+    #Install (live log), the actual work is done by engine.InstallEngine
+    run_engine(config)
+    #Done: Forgotten step: Network setup (engine "network" stage, asks us through a prompt)
     #Think it is done: Select Disk: use gparted as a suitable partition editor, and maybe gnome disks, Partition Scheme: Automatic (recommended), Manual (launch cfdisk)
     #Think it is done: Filesystem: ext4 or btrfs
     #in config["boot_mode"] Boot mode detection (UEFI vs BIOS auto)
@@ -626,16 +588,6 @@ def iso_stage(config):
     #Extras
     #Confirm
     #Check certain stuff, like if to install intel-ucode or amd-ucode
-    #Install (live log)
-
-
-
-    #config["username"]["pw"], config["username"]["name"], config["boot_mode"]. config["de"], config["de_packages"]
-    # Save config for chroot stage
-#    with open("/mnt/root/install_config.json", "w") as f:
-#        json.dump(config, f, indent=4)
-
-#    run_cmd(["arch-chroot", "/mnt", "python3", "/root/chroot_stage.py"], "Entering chroot stage")
 
 
 def chroot_stage():
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import urllib.request
+
+MIB = 1024 * 1024
+
+def cpu_count():
+    """Usable cores (respects taskset/cgroups), at least 1"""
+    try:
+        return len(os.sched_getaffinity(0)) or 1
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def ram_mib():
+    """MemTotal from /proc/meminfo in MiB, None if it can't be read"""
+    try:
+        with open("/proc/meminfo") as file:
+            for line in file:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def disk_write_mbps(directory, seconds=3, limit_mib=512):
+    """
+    Sequential write throughput of the filesystem at directory in MiB/s.
+
+    Writes (and fsyncs) up to limit_mib or for about seconds, whichever comes first, then deletes the file.
+    Returns None if the test file couldn't be written.
+    """
+    path = os.path.join(directory, ".installer-write-test")
+    block = b"\0" * (4 * MIB)
+    written = 0
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            start = time.monotonic()
+            while written < limit_mib * MIB and time.monotonic() - start < seconds:
+                written += os.write(fd, block)
+                if written % (64 * MIB) == 0:
+                    os.fsync(fd)# Page cache would make every disk look like RAM
+            os.fsync(fd)
+            elapsed = time.monotonic() - start
+        finally:
+            os.close(fd)
+            os.remove(path)
+    except OSError:
+        return None
+    return (written / MIB) / elapsed if elapsed > 0 else None
+
+
+def mirror_url(mirrorlist="/etc/pacman.d/mirrorlist", repo="extra", arch="x86_64"):
+    """First enabled mirror in mirrorlist, pointed at the repo files database (tens of MiB, good for a speed test)"""
+    try:
+        with open(mirrorlist) as file:
+            for line in file:
+                line = line.strip()
+                if line.startswith("Server") and "=" in line:
+                    server = line.split("=", 1)[1].strip()
+                    return server.replace("$repo", repo).replace("$arch", arch) + f"/{repo}.files"
+    except OSError:
+        pass
+    return None
+
+
+def network_mbps(url, seconds=3):
+    """
+    Download speed from url in MiB/s, reads for about seconds. None on failure.
+
+    The clock starts after the first chunk, DNS/TCP/TLS setup would otherwise dominate on fast links.
+    """
+    received = 0
+    try:
+        with urllib.request.urlopen(url, timeout=seconds) as response:
+            response.read(64 * 1024)
+            start = time.monotonic()
+            while time.monotonic() - start < seconds:
+                chunk = response.read(256 * 1024)
+                if not chunk:
+                    break
+                received += len(chunk)
+        elapsed = time.monotonic() - start
+    except (OSError, ValueError):
+        return None
+    if received == 0 or elapsed <= 0:
+        return None
+    return (received / MIB) / elapsed
+
+
+def tune(cores, ram, disk, net):
+    """
+    Install-time settings from the measurements (any of ram, disk, net may be None = unknown).
+
+    Returns dict with:
+    parallel_downloads: pacman ParallelDownloads
+    build_jobs: make/cargo/go jobs, one per core but at least ~1 GiB RAM per job
+    swap_mib: swap image size, smaller with more RAM and capped by what the disk writes in ~30s
+    parallel_stages: how many install stages may run at once (chroot commands still run one at a time)
+    """
+    if net is None:
+        parallel_downloads = 5  # pacman's default
+    elif net < 2:
+        parallel_downloads = 2
+    elif net < 10:
+        parallel_downloads = 5
+    elif net < 50:
+        parallel_downloads = 10
+    else:
+        parallel_downloads = 15
+
+    build_jobs = cores if ram is None else max(1, min(cores, ram // 1024))
+
+    if ram is None:
+        swap_mib = 4096
+    else:
+        swap_mib = min(16 * 1024, max(2048, 8192 - ram // 2))
+    if disk is not None:
+        swap_mib = max(1024, min(swap_mib, int(disk * 30)))
+
+    if cores >= 8 and (ram or 0) >= 8 * 1024:
+        parallel_stages = 3
+    elif cores >= 4 and (ram or 0) >= 4 * 1024:
+        parallel_stages = 2
+    else:
+        parallel_stages = 1
+    if disk is not None and disk < 50:
+        parallel_stages = 1  # Slow disk, running stages side by side would just fight over it
+
+    return {
+        "parallel_downloads": parallel_downloads,
+        "build_jobs": build_jobs,
+        "swap_mib": swap_mib,
+        "parallel_stages": parallel_stages,
+    }
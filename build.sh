@@ -7,6 +7,11 @@ ARGS="-v -w $work_dir -o $out_dir $profile_to_build"
 echo "Copying python stuff to airootfs"
 cp archiso-thing_installscript/*.py archiso-thing_installscript/launch.sh airootfs/usr/local/bin -f # Overwrite any files already existing
 
+# Groups in packages.x86_64 are installed in full, so the installer can skip them in clone mode
+echo "Writing package groups of the live image"
+mkdir -p airootfs/usr/local/share/installer
+grep -v '^#' packages.x86_64 | grep -xFf <(pacman -Sg | awk '{print $1}' | sort -u) > airootfs/usr/local/share/installer/live-groups || true
+
 if [ -d "$work_dir" ]; then
     read -p "Do you want to remove the work directory before running mkarchiso? (y/n): " remove_work_dir
     if [[ "$remove_work_dir" =~ ^[Yy]$ ]]; then